@@ -1,4 +1,5 @@
 import collections
+import functools
 
 import torch
 import numpy as np
@@ -15,13 +16,14 @@ def _pad(target, fill_value, pad_len, dim=0):
     return torch.cat([target, pad], dim=dim)
 
 
-def collate_fn(batch):
+def collate_fn(batch, input_dtype=torch.long, mask_dtype=torch.long):
 
     input_ids, attention_masks, labels, dial_id,  window_id, term_id = list(zip(*batch))
         
-    input_ids = [torch.tensor(instance) for i, instance in enumerate(input_ids)]
-    attention_masks = [torch.tensor(instance) for i, instance in enumerate(attention_masks)]
-    labels = [torch.tensor(instance) for i, instance in enumerate(labels)]
+    input_ids = [torch.tensor(instance, dtype=input_dtype) for i, instance in enumerate(input_ids)]
+    attention_masks = [torch.tensor(instance, dtype=mask_dtype) for i, instance in enumerate(attention_masks)]
+    # the datasets may hand out int32 arrays, the loss and _shift_right need int64 labels
+    labels = [torch.tensor(instance, dtype=torch.long) for i, instance in enumerate(labels)]
 
     dial_id = torch.tensor(dial_id)
     window_id = torch.tensor(window_id)
@@ -31,4 +33,8 @@ def collate_fn(batch):
     input_masks = rnn_utils.pad_sequence(attention_masks, batch_first=True, padding_value=0) # pad_id
     labels = rnn_utils.pad_sequence(labels, batch_first=True, padding_value=-100)
 
-    return input_ids, input_masks, labels, dial_id,  window_id, term_id
\ No newline at end of file
+    return input_ids, input_masks, labels, dial_id,  window_id, term_id
+
+
+# int32 ids and bool masks cut the host-to-device bytes of generation batches
+eval_collate_fn = functools.partial(collate_fn, input_dtype=torch.int32, mask_dtype=torch.bool)
@@ -1,7 +1,11 @@
 import glob
+import hashlib
+import itertools
+import json
 import logging
 import os
 import pickle
+import shutil
 import numpy as np
 import copy
 
@@ -9,61 +13,141 @@ import torch
 from torch.utils.data import Dataset
 
 from utils import dist_utils
+from utils.utils import file_fingerprint
 from .common_utils import read_json
 
 
 logger = logging.getLogger()
 
+FEATURE_NAMES = ('input_ids', 'input_offsets', 'labels', 'label_offsets', 'example_ids')
+
+
+def _flatten(sequences):
+    """Packs variable length id lists into one int32 array plus offsets."""
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(sequence) for sequence in sequences])
+    flat = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int32, count=int(offsets[-1]))
+    return flat, offsets
+
+
 class ReaderMedDataset_gen(torch.utils.data.Dataset):
-    def __init__(self, data_dir, tokenizer, stage='stage1', stage1_index_file=None):
+    """Generation dataset, tokenized once at construction.
+
+    With `cache_dir` the token ids are saved as .npy files keyed by the data
+    files and the tokenizer, and memory-mapped on later runs without reading
+    or tokenizing the json again.
+    """
+
+    def __init__(self, data_dir, tokenizer, stage='stage1', stage1_index_file=None, cache_dir=None,
+                 max_input_len=512, max_output_len=512):
         # stage='stage1','stage2'
         self.tokenizer = tokenizer
         self.stage = stage
+        self.max_input_len = max_input_len
+        self.max_output_len = max_output_len
         if dist_utils.is_local_master():
             logger.info(f"Data dir: {data_dir}")
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, self._cache_key(data_dir, stage1_index_file))
+        if cache_path is not None and os.path.exists(cache_path):
+            if dist_utils.is_local_master():
+                logger.info(f"Loading tokenized features from {cache_path}")
+            self.features = {
+                name: np.load(os.path.join(cache_path, f'{name}.npy'), mmap_mode='r')
+                for name in FEATURE_NAMES}
+        else:
+            self.features = self._build_features(self._read_examples(data_dir, stage1_index_file))
+            if cache_path is not None and dist_utils.is_local_master():
+                self._save_features(cache_path)
+
+        if dist_utils.is_local_master():
+            logger.info(f"Total data size: {len(self)}")
+
+    def _read_examples(self, data_dir, stage1_index_file):
         data = read_json(path=data_dir)
-        self.data = []
+        examples = []
         if self.stage == 'stage1':
             for example in data:
                 if example["term_id"] == -1:
-                    self.data.append(example)
+                    examples.append(example)
         elif self.stage == 'stage2':
             if stage1_index_file is None:
                 for example in data:
                     if example["term_id"] != -1:
-                        self.data.append(example)
+                        examples.append(example)
             else:
                 stage1_index = read_json(stage1_index_file)
                 for example in data:
                     if [example['dial_id'], example['window_id'], example['term_id']] in stage1_index:
-                        self.data.append(example)
-
-        if dist_utils.is_local_master():
-            logger.info(f"Total data size: {len(self.data)}")
+                        examples.append(example)
+        return examples
+
+    def _cache_key(self, data_dir, stage1_index_file):
+        key = hashlib.md5()
+        for path in (data_dir, stage1_index_file):
+            if path is not None:
+                key.update(file_fingerprint(path).encode('utf-8'))
+        key.update(f'{self.stage}|{self.max_input_len}|{self.max_output_len}|'.encode('utf-8'))
+        key.update(type(self.tokenizer).__name__.encode('utf-8'))
+        key.update(json.dumps(self.tokenizer.get_vocab(), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return key.hexdigest()
+
+    def _batch_encode(self, texts):
+        if not texts:
+            return []
+        return self.tokenizer(texts, add_special_tokens=True)['input_ids']
+
+    def _build_features(self, examples):
+        inputs = self._batch_encode([example['context'].lower() for example in examples])
+        inputs = [input[:self.max_input_len] for input in inputs]
+        labels = self._batch_encode([example['output'].lower() for example in examples])
+        labels = [label[1:self.max_output_len] for label in labels]
+
+        features = {}
+        features['input_ids'], features['input_offsets'] = _flatten(inputs)
+        features['labels'], features['label_offsets'] = _flatten(labels)
+        features['example_ids'] = np.array(
+            [[example['dial_id'], example['window_id'], example['term_id']] for example in examples],
+            dtype=np.int64).reshape(-1, 3)
+        return features
+
+    def _save_features(self, cache_path):
+        # Write to a temporary directory first so a partial cache is never picked up.
+        tmp_path = f'{cache_path}.tmp{os.getpid()}'
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in FEATURE_NAMES:
+            np.save(os.path.join(tmp_path, f'{name}.npy'), self.features[name])
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if not os.path.exists(cache_path):
+                raise
+            # another run wrote the same key first, its cache holds the same features
+            shutil.rmtree(tmp_path)
+            logger.info(f"Tokenized features already cached at {cache_path}")
+            return
+        logger.info(f"Saved tokenized features to {cache_path}")
 
-        # self.data = data
-
-    def convert_example_to_feature(
-        self,
-        example,
-        max_input_len=512,
-        max_output_len=512,
-    ):
-        input = self.tokenizer.encode(example['context'].lower(), add_special_tokens=True)[:max_input_len]
-        input_mask = [1] * len(input)
-        label = self.tokenizer.encode(example['output'].lower())[1:max_output_len]
-        dial_id = example['dial_id']
-        window_id = example['window_id']
-        term_id = example['term_id']
-        
+    def __getitem__(self, idx):
+        features = self.features
+        input_start, input_end = features['input_offsets'][idx: idx + 2]
+        label_start, label_end = features['label_offsets'][idx: idx + 2]
+        input = features['input_ids'][input_start: input_end]
+        input_mask = np.ones_like(input)
+        label = features['labels'][label_start: label_end]
+        dial_id, window_id, term_id = (int(x) for x in features['example_ids'][idx])
 
         return (input, input_mask, label, dial_id,  window_id, term_id)
 
-    def __getitem__(self, idx):
-        return self.convert_example_to_feature(self.data[idx])
+    @property
+    def lengths(self):
+        """Number of input tokens of each example."""
+        return np.diff(self.features['input_offsets'])
 
     def __len__(self):
-        return len(self.data)
+        return len(self.features['example_ids'])
 
 class ReaderMedDataset(torch.utils.data.Dataset):
     def __init__(self, data_dir, tokenizer):
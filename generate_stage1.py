@@ -10,15 +10,18 @@ import time
 import heapq
 from tqdm import tqdm
 
+import ahocorasick
 import argparse
 import glob
+import hashlib
 import logging
 import math
 import numpy as np
 import copy
 import torch
 import transformers as tfs
-from transformers import BertTokenizer, T5ForConditionalGeneration, Text2TextGenerationPipeline
+from transformers import BertTokenizerFast, T5ForConditionalGeneration, Text2TextGenerationPipeline
+from transformers.modeling_outputs import BaseModelOutput
 
 from data_utils import data_collator, reader_dataset
 from data_utils import utils as du
@@ -28,6 +31,7 @@ from utils import dist_utils
 from utils import model_utils
 from utils import options
 from utils import sampler
+from utils.prefetcher import CudaPrefetcher
 from utils import utils
 from preprocess_data import DatasetReader
 from tensorboardX import SummaryWriter
@@ -44,6 +48,10 @@ if logger.hasHandlers():
 console = logging.StreamHandler()
 logger.addHandler(console)
 
+# Source lengths are rounded up to a multiple of this for the CUDA-graph decoder,
+# so that batch shapes repeat and captured graphs get replayed.
+SRC_LENGTH_MULTIPLE = 64
+
 
 class ModelTrainer(object):
 
@@ -52,7 +60,7 @@ class ModelTrainer(object):
         utils.print_section_bar('Initializing components for training')
 
         logger.info("Loading tokenizer...")
-        tokenizer = BertTokenizer.from_pretrained(args.pretrained_model_cfg)
+        tokenizer = BertTokenizerFast.from_pretrained(args.pretrained_model_cfg)
         tokenizer.add_special_tokens({'additional_special_tokens': ['possible_statues']})
         logger.info("Tokenizer loaded and special tokens added.")
 
@@ -63,65 +71,147 @@ class ModelTrainer(object):
             logger.info(f"Resizing embedding from {cfg.vocab_size} to {len(tokenizer)}")
             model.resize_token_embeddings(len(tokenizer))
 
-        logger.info(f"Loading model state from {args.model_recover_path}...")
-        model.load_state_dict(torch.load(args.model_recover_path, map_location=args.device))
         model.to(args.device)
         logger.info("Model loaded and moved to device.")
 
+        # Opt-in: pure fp16 T5 can overflow, so generation stays fp32 by default.
+        if args.fp16_inference and args.device.type == 'cuda':
+            logger.info("Casting model to half precision for inference.")
+            model.half()
+        model.eval()
+
         self.model = model
         self.args = args
         self.tokenizer = tokenizer
 
+        self.trt_encoder = None
+        self.graph_decoder = None
+        if args.cuda_graph:
+            self.graph_decoder = model_utils.CudaGraphGreedyDecoder(
+                model, max_length=64, src_length_multiple=SRC_LENGTH_MULTIPLE)
+            if args.dev_batch_size > model_utils.CudaGraphGreedyDecoder.MAX_BATCH_SIZE:
+                logger.warning(
+                    f"--cuda_graph recomputes the full decoder buffer every step and is likely slower than "
+                    f"generate() at dev_batch_size = {args.dev_batch_size}; it targets batches of at most "
+                    f"{model_utils.CudaGraphGreedyDecoder.MAX_BATCH_SIZE}.")
+
+        if args.torch_compile:
+            if not hasattr(torch, 'compile'):
+                raise RuntimeError('--torch_compile requires torch >= 2.0.')
+            if args.cuda_graph:
+                # the graph decoder calls model.decoder directly, model.forward would never run
+                raise ValueError('--torch_compile and --cuda_graph cannot be combined.')
+            # generate() calls model.forward for every decoding step, so that is what gets compiled.
+            # dynamic=True since the kv cache grows by one step per call. The default mode is used:
+            # reduce-overhead's CUDA graphs free each step's outputs on the next call, but generate()
+            # feeds past_key_values back in, and T5 has no static cache to avoid that.
+            logger.info("Compiling model forward with torch.compile...")
+            model.forward = torch.compile(model.forward, fullgraph=False, dynamic=True)
+
+    def load_checkpoint(self, *model_recover_paths):
+        """Swaps the weights of the already constructed model in place.
+        When several checkpoints are given, their weights are averaged.
+        """
+        args = self.args
+        logger.info(f"Loading model state from {', '.join(model_recover_paths)}...")
+        self.model.load_state_dict(
+            model_utils.load_averaged_state_dict(model_recover_paths, map_location=args.device))
+
+        if args.use_trt:
+            max_length = 512
+            self.trt_encoder = model_utils.get_trt_encoder(
+                self.model, self._trt_cache_path(model_recover_paths, max_length),
+                batch_size=args.dev_batch_size, max_length=max_length)
+
+    def _trt_cache_path(self, model_recover_paths, max_length):
+        # The engine bakes in the weights, so the checkpoints are part of the key. Their size and
+        # mtime are included since retraining rewrites model.{i}.bin under the same path.
+        args = self.args
+        key = hashlib.md5()
+        for model_recover_path in model_recover_paths:
+            key.update(utils.file_fingerprint(model_recover_path).encode('utf-8'))
+        key.update(f'{args.pretrained_model_cfg}|{self.model.dtype}|{args.dev_batch_size}|{max_length}'.encode('utf-8'))
+        return os.path.join(args.cache_dir, f'trt_encoder.{key.hexdigest()}.ts')
+
     def get_eval_data_loader(self, eval_dataset):
         logger.info("Creating evaluation data loader...")
+        # Batches of similar input length waste less encoder compute on padding.
         if torch.distributed.is_initialized():
-            eval_sampler = sampler.SequentialDistributedSampler(
-                eval_dataset,
+            eval_sampler = sampler.LengthGroupedSequentialSampler(
+                eval_dataset.lengths,
                 num_replicas=self.args.distributed_world_size,
                 rank=self.args.local_rank)
         else:
             assert self.args.local_rank == -1
-            eval_sampler = torch.utils.data.SequentialSampler(eval_dataset)
+            eval_sampler = sampler.LengthGroupedSequentialSampler(eval_dataset.lengths)
+
+        num_workers = self.args.num_workers
+        if num_workers is None:
+            num_workers = min(8, (os.cpu_count() or 1) // self.args.distributed_world_size)
+        # Workers collate the next batches while the GPU is busy in generate().
+        worker_kwargs = {}
+        if num_workers > 0:
+            worker_kwargs = dict(persistent_workers=True, prefetch_factor=2)
 
         dataloader = torch.utils.data.DataLoader(
             eval_dataset,
             batch_size=self.args.dev_batch_size,
             pin_memory=True,
             sampler=eval_sampler,
-            num_workers=0,
-            collate_fn=data_collator.collate_fn,
-            drop_last=False)
+            num_workers=num_workers,
+            collate_fn=data_collator.eval_collate_fn,
+            drop_last=False,
+            **worker_kwargs)
         logger.info("Evaluation data loader created.")
         return dataloader
 
-    def validate(self):
+    def _encode(self, input_ids, input_masks):
+        if self.trt_encoder is not None:
+            hidden_states = self.trt_encoder(input_ids.int(), input_masks.int())
+            return BaseModelOutput(last_hidden_state=hidden_states.to(self.model.dtype))
+        return self.model.get_encoder()(input_ids=input_ids, attention_mask=input_masks, return_dict=True)
+
+    def _generate(self, input_ids, input_masks):
+        # Run the encoder once per batch and let generate() only drive the decoder.
+        encoder_outputs = self._encode(input_ids, input_masks)
+        if self.graph_decoder is not None:
+            return self.graph_decoder(encoder_outputs.last_hidden_state, input_masks)
+        return self.model.generate(
+            encoder_outputs=encoder_outputs, attention_mask=input_masks, max_length=64, num_beams=1,
+            num_return_sequences=1, use_cache=True)
+
+    def validate(self, eval_dataloader):
         logger.info("Starting validation...")
         args = self.args
 
-        logger.info(f"Loading evaluation dataset from {args.dev_file}...")
-        eval_dataset = reader_dataset.ReaderMedDataset_gen(args.dev_file, self.tokenizer, stage='stage1')
-        eval_dataloader = self.get_eval_data_loader(eval_dataset)
-
-        all_results = []
-        for step, batch in enumerate(eval_dataloader):
-            self.model.eval()
-            batch = tuple(t.to(args.device) for t in batch)
-            input_ids, input_masks, labels, dial_id, window_id, term_id = batch
-            logger.info(f"Processing batch {step + 1}/{len(eval_dataloader)}")
-
-            if args.local_rank != -1:
-                with self.model.no_sync(), torch.no_grad():
-                    outputs = self.model.generate(inputs=input_ids, attention_mask=input_masks, max_length=64)
-            else:
-                with torch.no_grad():
-                    outputs = self.model.generate(input_ids, attention_mask=input_masks, max_length=64, num_beams=1, num_return_sequences=1)
-            logger.info(f"Generated outputs for batch {step + 1}")
-
-            generated_texts = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
-            dial_id = list(dial_id.detach().cpu())
-            window_id = list(window_id.detach().cpu())
-            term_id = list(term_id.detach().cpu())
-            all_results.extend(zip(generated_texts, dial_id, window_id, term_id))
+        sample_order = list(eval_dataloader.sampler)
+        # input_ids and input_masks are streamed to the device one batch ahead.
+        eval_dataloader = CudaPrefetcher(eval_dataloader, args.device, device_fields=(0, 1))
+
+        all_outputs = []
+        all_ids = []
+        self.model.eval()
+        with torch.inference_mode():
+            for step, batch in enumerate(eval_dataloader):
+                input_ids, input_masks, labels, dial_id, window_id, term_id = batch
+                logger.info(f"Processing batch {step + 1}/{len(eval_dataloader)}")
+
+                outputs = self._generate(input_ids, input_masks)
+                logger.info(f"Generated outputs for batch {step + 1}")
+
+                # Pad to max_length so the whole pass can be decoded in one call.
+                outputs = torch.nn.functional.pad(
+                    outputs, (0, 64 - outputs.size(1)), value=self.tokenizer.pad_token_id)
+                all_outputs.append(outputs)
+                all_ids.append(torch.stack([dial_id, window_id, term_id], dim=1))
+
+        all_texts = []
+        if all_outputs:
+            all_texts = self.tokenizer.batch_decode(torch.cat(all_outputs).cpu(), skip_special_tokens=True)
+        all_ids = torch.cat(all_ids).tolist() if all_ids else []
+        all_results = [(text, *ids) for text, ids in zip(all_texts, all_ids)]
+        # The sampler yields examples sorted by length, restore the dataset order.
+        all_results = [result for _, result in sorted(zip(sample_order, all_results), key=lambda x: x[0])]
 
         logger.info("Validation completed.")
         return all_results
@@ -130,7 +220,12 @@ class ModelTrainer(object):
 def post_process(predicts, data_dir):
     predict_ids = []
     reader = DatasetReader(data_dir=data_dir)
-    all_terms = list(reader.term_ids.keys())
+    term_ids = reader.term_ids
+    all_terms = frozenset(term_ids)
+    term_automaton = ahocorasick.Automaton()
+    for term, term_id in term_ids.items():
+        term_automaton.add_word(term, term_id)
+    term_automaton.make_automaton()
     for predict in predicts:
         generated_text, dial_id, window_id, _ = predict
         dial_id = int(dial_id)
@@ -138,18 +233,14 @@ def post_process(predicts, data_dir):
 
         # get predicted term
         generated_terms = ''.join(generated_text.split(' ')).split('，')
-        generated_term_list = []
+        generated_term_ids = set()
         for term in generated_terms:
             if term in all_terms:
-                generated_term_list.append(term)
+                generated_term_ids.add(term_ids[term])
             else:
-                for term_ in all_terms:
-                    if term_ in term:
-                        generated_term_list.append(term_)
-        generated_term_list = list(set(generated_term_list))
-        generated_term_id_list = [reader.term_ids[term] for term in generated_term_list]
-        for term_id in generated_term_id_list:
-            predict_ids.append([dial_id, window_id, int(term_id)])
+                # every known term occurring as a substring of the generated one
+                generated_term_ids.update(term_id for _, term_id in term_automaton.iter(term))
+        predict_ids.extend([dial_id, window_id, int(term_id)] for term_id in sorted(generated_term_ids))
     return predict_ids
 
 def main():
@@ -174,6 +265,7 @@ def main():
     # Ensure model_recover_dir and log_dir are set correctly
     args.model_recover_dir = os.path.join(args.output_dir, args.model_recover_dir)
     args.log_dir = os.path.join(args.output_dir, args.log_dir)
+    args.cache_dir = os.path.join(args.output_dir, args.cache_dir)
 
     # Ensure train_file and dev_file are set correctly
     args.train_file = os.path.join(args.data_dir, args.train_file)
@@ -198,11 +290,23 @@ def main():
     mode = args.dev_file.split('/')[-1].split('.')[0]
     model_dir = args.model_recover_dir.split('/model')[0]
 
-    for i in range(0, 4):
+    trainer = ModelTrainer(args)
+
+    # The dataset and its loader are shared by all checkpoints.
+    logger.info(f"Loading evaluation dataset from {args.dev_file}...")
+    eval_dataset = reader_dataset.ReaderMedDataset_gen(
+        args.dev_file, trainer.tokenizer, stage='stage1', cache_dir=args.cache_dir)
+    eval_dataloader = trainer.get_eval_data_loader(eval_dataset)
+
+    if args.average_checkpoints:
+        runs = [('avg', [args.model_recover_dir.format(i) for i in range(0, 4)])]
+    else:
+        runs = [(i, [args.model_recover_dir.format(i)]) for i in range(0, 4)]
+
+    for i, model_recover_paths in runs:
         logger.info(f"Starting validation for model iteration {i}...")
-        args.model_recover_path = args.model_recover_dir.format(i)
-        trainer = ModelTrainer(args)
-        predicts = trainer.validate()
+        trainer.load_checkpoint(*model_recover_paths)
+        predicts = trainer.validate(eval_dataloader)
         logger.info(f"Validation complete for model iteration {i}.")
 
         predict_ids = post_process(predicts, data_dir=args.origin_data_dir)
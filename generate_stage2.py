@@ -17,7 +17,7 @@ import math
 import numpy as np
 import torch
 import transformers as tfs
-from transformers import BertTokenizer, T5ForConditionalGeneration, Text2TextGenerationPipeline
+from transformers import BertTokenizerFast, T5ForConditionalGeneration, Text2TextGenerationPipeline
 
 from data_utils import data_collator, reader_dataset
 from data_utils import utils as du
@@ -51,7 +51,7 @@ class ModelTrainer(object):
 
         utils.print_section_bar('Initializing components for training')
 
-        tokenizer = BertTokenizer.from_pretrained(
+        tokenizer = BertTokenizerFast.from_pretrained(
             args.pretrained_model_cfg)
         # tokenizer.add_special_tokens(
         #     {'additional_special_tokens': config.TOKENS})
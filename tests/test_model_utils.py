@@ -0,0 +1,50 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from utils import model_utils
+
+
+def _tiny_t5(seed):
+    torch.manual_seed(seed)
+    cfg = transformers.T5Config(
+        vocab_size=32, d_model=8, d_kv=4, d_ff=16, num_layers=1, num_heads=2,
+        decoder_start_token_id=0, tie_word_embeddings=True)
+    return transformers.T5ForConditionalGeneration(cfg)
+
+
+def test_load_averaged_state_dict_with_tied_embeddings(tmp_path):
+    models = [_tiny_t5(seed) for seed in (0, 1)]
+    paths = []
+    for i, model in enumerate(models):
+        state_dict = model.state_dict()
+        # the saved state dict aliases the tied embeddings, as train.py's checkpoints do
+        assert state_dict['shared.weight'].data_ptr() == state_dict['encoder.embed_tokens.weight'].data_ptr()
+        path = str(tmp_path / f'model.{i}.bin')
+        torch.save(state_dict, path)
+        paths.append(path)
+
+    averaged = model_utils.load_averaged_state_dict(paths)
+
+    expected = {
+        key: (models[0].state_dict()[key] + models[1].state_dict()[key]) / 2
+        for key in ('shared.weight', 'encoder.embed_tokens.weight', 'decoder.embed_tokens.weight',
+                    'encoder.block.0.layer.0.SelfAttention.q.weight')}
+    for key, value in expected.items():
+        assert torch.allclose(averaged[key], value), key
+
+    target = _tiny_t5(2)
+    target.load_state_dict(averaged)
+    assert torch.allclose(target.shared.weight, expected['shared.weight'])
+
+
+def test_load_averaged_state_dict_single_path(tmp_path):
+    model = _tiny_t5(0)
+    path = str(tmp_path / 'model.0.bin')
+    torch.save(model.state_dict(), path)
+
+    loaded = model_utils.load_averaged_state_dict([path])
+
+    for key, value in model.state_dict().items():
+        assert torch.equal(loaded[key], value), key
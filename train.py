@@ -16,7 +16,7 @@ import math
 import numpy as np
 import torch
 import transformers as tfs
-from transformers import BertTokenizer, T5ForConditionalGeneration
+from transformers import BertTokenizerFast, T5ForConditionalGeneration
 
 from data_utils import data_collator, reader_dataset
 from utils import dist_utils
@@ -46,7 +46,7 @@ class ModelTrainer(object):
         utils.print_section_bar('Initializing components for training')
         logger.info('Initializing components for training')
 
-        tokenizer = BertTokenizer.from_pretrained(args.pretrained_model_cfg)
+        tokenizer = BertTokenizerFast.from_pretrained(args.pretrained_model_cfg)
         tokenizer.add_special_tokens({'additional_special_tokens': ['<eot>']})
 
         cfg = tfs.BertConfig.from_pretrained(args.pretrained_model_cfg)
@@ -42,14 +42,30 @@ def all_reduce(tensor, group=None):
     return dist.all_reduce(tensor, group=group)
 
 
-def all_gather_list(data, group=None, max_size=16384):
+def all_gather_list(data, group=None, max_size=16384, use_buffer=False):
     """Gathers arbitrary data from all nodes into a list.
     Similar to :func:`~torch.distributed.all_gather` but for arbitrary Python
     data. Note that *data* must be picklable.
     Args:
         data (Any): data from the local worker to be gathered on other workers
         group (optional): group of the collective
+        max_size (int, optional): per-worker buffer size, only used with
+            *use_buffer*
+        use_buffer (bool, optional): gather through a ``max_size`` padded byte
+            buffer and an all_reduce instead of
+            :func:`~torch.distributed.all_gather_object`
     """
+    if use_buffer:
+        return _all_gather_list_buffer(data, group=group, max_size=max_size)
+
+    # all_gather_object negotiates the payload sizes, so only the actual
+    # pickled bytes are moved instead of max_size * world_size.
+    result = [None] * get_world_size()
+    dist.all_gather_object(result, data, group=group)
+    return result
+
+
+def _all_gather_list_buffer(data, group=None, max_size=16384):
     SIZE_STORAGE_BYTES = 4  # int32 to encode the payload size
 
     enc = pickle.dumps(data)
@@ -79,25 +95,27 @@ def all_gather_list(data, group=None, max_size=16384):
 
     size_bytes = enc_size.to_bytes(SIZE_STORAGE_BYTES, byteorder='big')
 
-    cpu_buffer[0:SIZE_STORAGE_BYTES] = torch.ByteTensor(list(size_bytes))
-    cpu_buffer[SIZE_STORAGE_BYTES: enc_size + SIZE_STORAGE_BYTES] = torch.ByteTensor(list(enc))
+    # bytearray gives frombuffer a writable view, no per-byte Python ints are created.
+    cpu_buffer[0:SIZE_STORAGE_BYTES].copy_(torch.frombuffer(bytearray(size_bytes), dtype=torch.uint8))
+    cpu_buffer[SIZE_STORAGE_BYTES: enc_size + SIZE_STORAGE_BYTES].copy_(
+        torch.frombuffer(bytearray(enc), dtype=torch.uint8))
 
     start = rank * max_size
     size = enc_size + SIZE_STORAGE_BYTES
     buffer[start: start + size].copy_(cpu_buffer[:size])
 
     all_reduce(buffer, group=group)
+    host_buffer = buffer.cpu().numpy()
 
     try:
         result = []
         for i in range(world_size):
-            out_buffer = buffer[i * max_size: (i + 1) * max_size]
-            size = int.from_bytes(out_buffer[0:SIZE_STORAGE_BYTES], byteorder='big')
+            out_buffer = host_buffer[i * max_size: (i + 1) * max_size]
+            size = int.from_bytes(out_buffer[0:SIZE_STORAGE_BYTES].tobytes(), byteorder='big')
             if size > 0:
                 result.append(
                     pickle.loads(
-                        bytes(
-                            out_buffer[SIZE_STORAGE_BYTES: size+SIZE_STORAGE_BYTES].tolist())))
+                        out_buffer[SIZE_STORAGE_BYTES: size+SIZE_STORAGE_BYTES].tobytes()))
         return result
     except pickle.UnpicklingError:
         raise Exception(
@@ -109,6 +127,36 @@ def all_gather_list(data, group=None, max_size=16384):
             'while other workers are still iterating over their portions of the data.')
 
 
+def all_gather_tensor_dict(data, group=None):
+    """Gathers a dict of tensors from all nodes without pickling.
+    Unlike :func:`all_gather_list` the payload must be homogeneous: every
+    worker passes the same keys, with tensors of the same shape and dtype on
+    its CUDA device.
+    Args:
+        data (Dict[str, torch.Tensor]): tensors from the local worker
+        group (optional): group of the collective
+    Returns:
+        Dict mapping each key to a tensor of shape ``(world_size, *shape)``.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return {key: tensor.unsqueeze(0) for key, tensor in data.items()}
+
+    if group is None:
+        group = get_default_group()
+    # all_gather_into_tensor is called _all_gather_base before torch 1.13
+    all_gather_into_tensor = getattr(dist, 'all_gather_into_tensor', None) or dist._all_gather_base
+
+    result = {}
+    # same key order on every worker so the collectives line up
+    for key in sorted(data):
+        tensor = data[key].contiguous()
+        output = tensor.new_empty(world_size * tensor.numel())
+        all_gather_into_tensor(output, tensor.view(-1), group=group)
+        result[key] = output.view((world_size,) + tuple(tensor.size()))
+    return result
+
+
 def all_gather(data, to_cpu=True):
     world_size = get_world_size()
     if world_size == 1:
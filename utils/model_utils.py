@@ -1,4 +1,5 @@
 import os
+import math
 import logging
 from typing import List
 
@@ -46,6 +47,222 @@ def setup_for_distributed_mode(
     return model, optimizer
 
 
+class _T5EncoderWrapper(nn.Module):
+    """Exposes a T5 encoder as a tensor-in/tensor-out module for tracing."""
+
+    def __init__(self, encoder: nn.Module):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(
+            input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+def get_trt_encoder(
+    model: nn.Module,
+    cache_path: str,
+    batch_size: int,
+    max_length: int = 512,
+    opt_length: int = 256,
+) -> nn.Module:
+    """Compiles the encoder of a T5 model into a Torch-TensorRT FP16 engine.
+
+    The engine takes int32 `input_ids` and `attention_mask` and returns the
+    last hidden state. It is saved to `cache_path` so that later runs on the
+    same checkpoint skip the compilation.
+    """
+    try:
+        import torch_tensorrt
+    except ImportError:
+        raise ImportError(
+            "Please install torch_tensorrt from https://github.com/pytorch/TensorRT to use TensorRT inference."
+        )
+
+    device = next(model.parameters()).device
+    if os.path.exists(cache_path):
+        logger.info(f"Loading TensorRT encoder from {cache_path}")
+        return torch.jit.load(cache_path, map_location=device)
+
+    logger.info(f"Compiling TensorRT encoder, batch size = {batch_size}, max length = {max_length}")
+    encoder = _T5EncoderWrapper(model.get_encoder()).eval()
+    example = torch.ones((batch_size, opt_length), dtype=torch.int32, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(encoder, (example, example))
+
+    inputs = [
+        torch_tensorrt.Input(
+            min_shape=(1, 1),
+            opt_shape=(batch_size, opt_length),
+            max_shape=(batch_size, max_length),
+            dtype=torch.int32)
+        for _ in range(2)
+    ]
+    trt_encoder = torch_tensorrt.compile(traced, inputs=inputs, enabled_precisions={torch.half})
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    torch.jit.save(trt_encoder, cache_path)
+    logger.info(f"Saved TensorRT encoder to {cache_path}")
+    return trt_encoder
+
+
+class CudaGraphGreedyDecoder(object):
+    """Greedy decoding for T5 where every decoding step is one CUDA graph replay.
+
+    The decoder always runs over the whole `max_length` target buffer without a
+    kv cache, so every step launches the same kernels on the same shapes. Causal
+    self-attention keeps the not yet generated positions from affecting the
+    current one. The step counter, the argmax and the write of the next token
+    all happen on the device, so no host sync is needed between steps.
+
+    One graph is captured per (batch size, source length rounded up to
+    `src_length_multiple`). Since load_state_dict() copies in place, the graphs
+    stay valid when another checkpoint is loaded into the same model.
+
+    Only plain argmax decoding is implemented, so the constructor refuses
+    generation configs that set sampling or any logits processor. Recomputing
+    the full target buffer costs about max_length / 2 times the decoder FLOPs
+    of the kv-cached generate(); this only pays off while decoding is
+    launch-bound, i.e. for batches up to about `MAX_BATCH_SIZE`. The speedup
+    has not been measured.
+    """
+
+    MAX_BATCH_SIZE = 32
+
+    # generation config fields that turn on behaviour the argmax loop does not implement,
+    # with the value that leaves them off
+    _UNSUPPORTED_GENERATION_FIELDS = {
+        'do_sample': False,
+        'repetition_penalty': 1.0,
+        'no_repeat_ngram_size': 0,
+        'encoder_no_repeat_ngram_size': 0,
+        'min_length': 0,
+        'min_new_tokens': None,
+        'forced_bos_token_id': None,
+        'forced_eos_token_id': None,
+        'bad_words_ids': None,
+        'suppress_tokens': None,
+        'begin_suppress_tokens': None,
+    }
+
+    def __init__(self, model, max_length=64, src_length_multiple=64, check_every=8, num_warmup_steps=3):
+        config = getattr(model, 'generation_config', model.config)
+        assert config.eos_token_id is not None, 'Greedy decoding needs an eos token.'
+        for name, off_value in self._UNSUPPORTED_GENERATION_FIELDS.items():
+            value = getattr(config, name, None)
+            if value is not None and value != off_value:
+                raise ValueError(
+                    f'CudaGraphGreedyDecoder only does plain greedy decoding, but the generation config sets '
+                    f'{name} = {value!r}.')
+
+        self.model = model
+        self.max_length = max_length
+        self.src_length_multiple = src_length_multiple
+        self.check_every = check_every
+        self.num_warmup_steps = num_warmup_steps
+        self.decoder_start_token_id = config.decoder_start_token_id
+        self.eos_token_id = config.eos_token_id
+        self.pad_token_id = config.pad_token_id
+        # T5ForConditionalGeneration rescales the decoder output before a tied lm_head.
+        if model.config.tie_word_embeddings:
+            self.output_scale = model.config.d_model ** -0.5
+        else:
+            self.output_scale = 1.0
+        self.pool = torch.cuda.graph_pool_handle()
+        self.graphs = {}
+
+    def _step(self, state):
+        hidden_states = self.model.decoder(
+            input_ids=state['decoder_input_ids'],
+            encoder_hidden_states=state['encoder_hidden_states'],
+            encoder_attention_mask=state['encoder_attention_mask'],
+            use_cache=False,
+            return_dict=True).last_hidden_state
+        batch_size, _, hidden_size = hidden_states.size()
+
+        index = state['step'].view(1, 1, 1).expand(batch_size, 1, hidden_size)
+        hidden_states = hidden_states.gather(1, index).squeeze(1)
+        next_tokens = self.model.lm_head(hidden_states * self.output_scale).argmax(dim=-1)
+        next_tokens = next_tokens.masked_fill(~state['unfinished'], self.pad_token_id)
+
+        state['step'].add_(1)
+        index = state['step'].view(1, 1).expand(batch_size, 1)
+        state['decoder_input_ids'].scatter_(1, index, next_tokens.unsqueeze(1))
+        state['unfinished'].logical_and_(next_tokens != self.eos_token_id)
+
+    def _reset(self, state):
+        state['decoder_input_ids'].fill_(self.pad_token_id)
+        state['decoder_input_ids'][:, 0] = self.decoder_start_token_id
+        state['step'].zero_()
+        state['unfinished'].fill_(True)
+
+    def _capture(self, batch_size, src_length, hidden_size, dtype, device):
+        state = {
+            'encoder_hidden_states': torch.zeros((batch_size, src_length, hidden_size), dtype=dtype, device=device),
+            'encoder_attention_mask': torch.zeros((batch_size, src_length), dtype=torch.long, device=device),
+            'decoder_input_ids': torch.zeros((batch_size, self.max_length), dtype=torch.long, device=device),
+            'step': torch.zeros((), dtype=torch.long, device=device),
+            'unfinished': torch.ones(batch_size, dtype=torch.bool, device=device),
+        }
+        self._reset(state)
+
+        logger.info(f"Capturing decoder CUDA graph, batch size = {batch_size}, source length = {src_length}")
+        side_stream = torch.cuda.Stream(device=device)
+        side_stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(side_stream):
+            for _ in range(self.num_warmup_steps):
+                self._step(state)
+        torch.cuda.current_stream(device).wait_stream(side_stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool):
+            self._step(state)
+        return graph, state
+
+    def __call__(self, encoder_hidden_states, attention_mask):
+        batch_size, src_length, hidden_size = encoder_hidden_states.size()
+        padded_length = math.ceil(src_length / self.src_length_multiple) * self.src_length_multiple
+
+        key = (batch_size, padded_length)
+        if key not in self.graphs:
+            self.graphs[key] = self._capture(
+                batch_size, padded_length, hidden_size, encoder_hidden_states.dtype, encoder_hidden_states.device)
+        graph, state = self.graphs[key]
+
+        state['encoder_hidden_states'][:, :src_length].copy_(encoder_hidden_states)
+        state['encoder_hidden_states'][:, src_length:].zero_()
+        state['encoder_attention_mask'][:, :src_length].copy_(attention_mask)
+        state['encoder_attention_mask'][:, src_length:].zero_()
+        self._reset(state)
+
+        num_steps = 0
+        while num_steps < self.max_length - 1:
+            graph.replay()
+            num_steps += 1
+            if num_steps % self.check_every == 0 and not state['unfinished'].any():
+                break
+        return state['decoder_input_ids'][:, :num_steps + 1].clone()
+
+
+def load_averaged_state_dict(paths, map_location=None):
+    """Loads the element-wise average of the state dicts saved at `paths`.
+
+    T5 state dicts tie `shared`, the encoder/decoder `embed_tokens` and maybe
+    `lm_head` to one storage, so the sum is built out of place; in-place
+    updates would hit the shared storage once per alias.
+    """
+    state_dict = {}
+    for path in paths:
+        for key, value in torch.load(path, map_location=map_location).items():
+            if key in state_dict:
+                state_dict[key] = state_dict[key] + value
+            else:
+                state_dict[key] = value
+    if len(paths) > 1:
+        state_dict = {key: value / len(paths) for key, value in state_dict.items()}
+    return state_dict
+
+
 def move_to_device(sample, device):
     if len(sample) == 0:
         return {}
@@ -177,6 +177,12 @@ def add_training_params(parser: argparse.ArgumentParser):
         type=int,
         default=512,
         help='amount of questions per batch for dev set validation.')
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=None,
+        help=('Number of data loading workers for evaluation. Defaults to '
+              'min(8, cpu_count // world_size).'))
     parser.add_argument(
         '--seed',
         type=int,
@@ -297,6 +303,11 @@ def add_training_params(parser: argparse.ArgumentParser):
     #     default='dataset/Chunyu/exp_t5_base_chinese_add_category_add_state/log',
     #     help='Output directory for checkpoints.')
 
+    parser.add_argument(
+        '--cache_dir',
+        type=str,
+        default='cache',
+        help='Directory for cached inference artifacts (e.g. TensorRT engines).')
     parser.add_argument(
         '--model_recover_dir',
         type=str,
@@ -308,6 +319,11 @@ def add_training_params(parser: argparse.ArgumentParser):
         default=None,
         # default='dataset/Chunyu/exp_t5_small_chinese_stage_all/model.35.bin',
         help='Output directory for checkpoints.')
+    parser.add_argument(
+        '--average_checkpoints',
+        action='store_true',
+        default=False,
+        help='Average the weights of the saved checkpoints and generate once.')
     parser.add_argument(
         '--inference_only',
         action='store_true',
@@ -379,6 +395,26 @@ def add_cuda_params(parser: argparse.ArgumentParser):
         default='O2',
         help=('For fp16: Apex AMP optimization level selected.'
               'See details at https://nvidia.github.io/apex/amp.html.'))
+    parser.add_argument(
+        '--fp16_inference',
+        action='store_true',
+        default=False,
+        help='Cast the model to half precision for generation (CUDA only).')
+    parser.add_argument(
+        '--use_trt',
+        action='store_true',
+        default=False,
+        help='Compile the T5 encoder with Torch-TensorRT for generation.')
+    parser.add_argument(
+        '--cuda_graph',
+        action='store_true',
+        default=False,
+        help='Replay the greedy decoding steps as CUDA graphs during generation.')
+    parser.add_argument(
+        '--torch_compile',
+        action='store_true',
+        default=False,
+        help='Compile the model forward with torch.compile for generation (torch >= 2.0).')
 
 
 def get_encoder_checkpoint_params_names():
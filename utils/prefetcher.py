@@ -0,0 +1,64 @@
+import torch
+
+
+class CudaPrefetcher(object):
+    """Wraps a DataLoader and copies the next batch to the GPU on a side
+    stream while the current batch is being consumed.
+
+    Only the tensors at the positions in `device_fields` are moved (all of
+    them by default), the others are yielded as they came out of the loader.
+    On a non-CUDA device the batches are moved synchronously.
+    """
+
+    def __init__(self, loader, device, device_fields=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.device_fields = device_fields
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(device=self.device)
+        else:
+            self.stream = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _fields(self, batch):
+        if self.device_fields is None:
+            return range(len(batch))
+        return self.device_fields
+
+    def _to_device(self, batch):
+        batch = list(batch)
+        for i in self._fields(batch):
+            batch[i] = batch[i].to(self.device, non_blocking=True)
+        return batch
+
+    def _preload(self, batch):
+        with torch.cuda.stream(self.stream):
+            batch = self._to_device(batch)
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, ready
+
+    def _wait(self, batch, ready):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(ready)
+        for i in self._fields(batch):
+            # the memory was allocated on the side stream but is used on the current one
+            batch[i].record_stream(current_stream)
+        return tuple(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield tuple(self._to_device(batch))
+            return
+
+        pending = None
+        for batch in self.loader:
+            batch = self._preload(batch)
+            if pending is not None:
+                yield self._wait(*pending)
+            pending = batch
+        if pending is not None:
+            yield self._wait(*pending)
@@ -210,4 +210,34 @@ class SequentialDistributedSampler(Sampler):
         return iter(indices)
 
     def __len__(self):
-        return self.num_samples
\ No newline at end of file
+        return self.num_samples
+
+
+class LengthGroupedSequentialSampler(Sampler):
+    """
+    Deterministic eval sampler that yields examples from the longest to the shortest input, so that each batch holds
+    sequences of similar length and the collator adds little padding. The longest batch comes first so that an OOM
+    happens sooner rather than later. With several replicas the sorted indices are dealt out round-robin, after adding
+    extra samples to make them evenly divisible like in `SequentialDistributedSampler`.
+    Results come back in sampler order; use the indices of the sampler to restore the dataset order.
+    """
+
+    def __init__(self, lengths, num_replicas=1, rank=0):
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(len(lengths) / num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+        # sorted() is stable, examples of equal length keep their dataset order
+        indices = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        indices += indices[: (self.total_size - len(indices))]
+        self.indices = indices[self.rank : self.total_size : self.num_replicas]
+        assert (
+            len(self.indices) == self.num_samples
+        ), f"Indices length {len(self.indices)} and sample number {self.num_samples} mismatched"
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return self.num_samples
@@ -42,6 +42,12 @@ def recall_score_at_k(lst, answer_num):
     return recall_list
 
 
+def file_fingerprint(path):
+    """Identifies a file by its path, size and modification time, for cache keys."""
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|'
+
+
 def softlink(target, link_name):
     temp_link = link_name + '.new'
     try: